@@ -2,7 +2,17 @@ from sqlmodel import Session, SQLModel, create_engine
 
 from app.settings import settings
 
-engine = create_engine(settings.DATABASE_URL, echo=settings.DEBUG_MODE)
+engine = create_engine(
+    settings.DATABASE_URL,
+    echo=settings.DEBUG_MODE,
+    connect_args={
+        "options": (
+            f"-c tcp_keepalives_idle={settings.DB_TCP_KEEPALIVES_IDLE} "
+            f"-c tcp_keepalives_interval={settings.DB_TCP_KEEPALIVES_INTERVAL} "
+            f"-c tcp_keepalives_count={settings.DB_TCP_KEEPALIVES_COUNT}"
+        )
+    },
+)
 
 
 def create_db_and_tables():
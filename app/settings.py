@@ -18,6 +18,15 @@ class Settings(BaseSettings):
         f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/"
         f"{POSTGRES_DB}"
     )
+    # A crashed worker's row lock is released as soon as its process dies.
+    # These keepalives only matter when a whole worker host or its network is lost,
+    # Postgres then releases the lock within about a minute instead of two hours.
+    # Trade-off: an outage this long also ends a live worker's session, and a
+    # duplicate delivery may then render the same pages again. That is only wasted
+    # work, pages are written atomically through per-attempt temporary files.
+    DB_TCP_KEEPALIVES_IDLE: int = 30
+    DB_TCP_KEEPALIVES_INTERVAL: int = 10
+    DB_TCP_KEEPALIVES_COUNT: int = 3
 
     # RabbitMQ settings
     RABBITMQ_HOST: str = "rabbitmq"
@@ -1,9 +1,23 @@
+import os
+import shutil
+import time
+import uuid
 from pathlib import Path
 
 import pytest
+from sqlmodel import Session, select
 
+from app.db import engine
+from app.models import Document, DocumentStatus
+from app.settings import settings
 from app.tests.conftest import TEST_FILES_PATH
-from app.worker import render_and_save_pages, render_pdf_document
+from app.worker import (
+    STALE_TEMP_PAGE_AGE_S,
+    DocumentLockedError,
+    is_page_rendered,
+    render_and_save_pages,
+    render_pdf_document,
+)
 
 
 # Distributed test example, pseudocode
@@ -24,3 +38,71 @@ def test_render_and_save_pages_sync():
     render_and_save_pages(document_id)
 
     # look directly in file system and check those pages
+
+
+def test_render_and_save_pages_resumes(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOADS_PATH", tmp_path)
+    monkeypatch.setattr(settings, "PAGES_PATH", tmp_path)
+    document_id = uuid.uuid4()
+    shutil.copy(Path(TEST_FILES_PATH, "valid_0.pdf"), tmp_path / f"{document_id}.pdf")
+    # Left behind by a lost attempt, and being written by a live one
+    stale_temp_path = tmp_path / f"{document_id}_1.png.{uuid.uuid4().hex}.tmp"
+    stale_temp_path.write_bytes(b"partial")
+    stale_mtime = time.time() - STALE_TEMP_PAGE_AGE_S - 60
+    os.utime(stale_temp_path, (stale_mtime, stale_mtime))
+    live_temp_path = tmp_path / f"{document_id}_2.png.{uuid.uuid4().hex}.tmp"
+    live_temp_path.write_bytes(b"partial")
+
+    num_pages = render_and_save_pages(document_id)
+    assert num_pages > 1
+    page_paths = [tmp_path / f"{document_id}_{n}.png" for n in range(1, num_pages + 1)]
+    assert all(is_page_rendered(page_path) for page_path in page_paths)
+    assert list(tmp_path.glob("*.tmp")) == [live_temp_path]
+
+    # Truncated page (e.g. from a lost worker) is rendered again, others are kept
+    page_paths[-1].write_bytes(page_paths[-1].read_bytes()[:100])
+    assert not is_page_rendered(page_paths[-1])
+    stats = [(path.stat().st_ino, path.stat().st_mtime_ns) for path in page_paths]
+
+    assert render_and_save_pages(document_id) == num_pages
+    assert is_page_rendered(page_paths[-1])
+    new_stats = [(path.stat().st_ino, path.stat().st_mtime_ns) for path in page_paths]
+    assert new_stats[:-1] == stats[:-1]
+    assert new_stats[-1][0] != stats[-1][0]
+
+
+def test_render_pdf_document_already_done(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOADS_PATH", tmp_path)
+    monkeypatch.setattr(settings, "PAGES_PATH", tmp_path)
+    with Session(engine) as session:
+        document = Document(
+            original_filename="valid_0.pdf", status=DocumentStatus.DONE, n_pages=1
+        )
+        session.add(document)
+        session.commit()
+        session.refresh(document)
+
+    # Redelivered message for a finished document is a no-op
+    assert render_pdf_document(str(document.id)) is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_render_pdf_document_locked(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOADS_PATH", tmp_path)
+    monkeypatch.setattr(settings, "PAGES_PATH", tmp_path)
+    with Session(engine) as session:
+        document = Document(
+            original_filename="valid_0.pdf", status=DocumentStatus.PROCESSING
+        )
+        session.add(document)
+        session.commit()
+        session.refresh(document)
+
+        # Hold the row lock as the worker rendering the document would
+        statement = select(Document).where(Document.id == document.id).with_for_update()
+        session.exec(statement).first()
+
+        # Duplicate delivery is retried instead of being acked
+        with pytest.raises(DocumentLockedError):
+            render_pdf_document(str(document.id))
+        assert not list(tmp_path.iterdir())
@@ -1,4 +1,7 @@
 import logging
+import os
+import time
+import uuid
 from datetime import datetime
 from pathlib import Path
 
@@ -9,7 +12,7 @@ from dramatiq.brokers.stub import StubBroker
 from PIL import Image
 from pydantic import UUID4
 from pypdfium2 import PdfiumError
-from sqlmodel import Session
+from sqlmodel import Session, select
 
 from app.db import engine
 from app.models import Document, DocumentStatus
@@ -27,6 +30,16 @@ dramatiq.set_broker(broker)
 
 logger = logging.getLogger("seshat-worker")
 
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_TRAILER = b"IEND\xaeB`\x82"
+# A temporary page is only written for the few seconds of a single save,
+# older ones were left behind by a lost attempt
+STALE_TEMP_PAGE_AGE_S = 10 * 60
+
+MAX_RETRIES = 5
+LOCKED_MAX_RETRIES = 30
+LOCKED_RETRY_DELAY_MS = 60 * 1000
+
 
 class IDNotFoundError(Exception):
     """Exception raised when the document ID is not found in the database."""
@@ -34,15 +47,48 @@ class IDNotFoundError(Exception):
     pass
 
 
+class DocumentLockedError(dramatiq.Retry):
+    """Exception raised when the document row is locked by another worker."""
+
+    pass
+
+
+def should_retry(retries: int, exception: Exception) -> bool:
+    if isinstance(exception, DocumentLockedError):
+        return retries < LOCKED_MAX_RETRIES
+    return retries < MAX_RETRIES
+
+
 # If PdfiumError or IDNotFoundError are thrown, task will not be retried.
+# DocumentLockedError means a duplicate delivery found another worker rendering the
+# document. It is retried every minute without a traceback, for up to about 30 minutes,
+# until the other worker finishes (DONE, nothing to do) or its lock is released
+# (resume from the rendered pages). Other errors get the usual 5 retries with backoff.
 @dramatiq.actor(
-    max_retries=5,
+    retry_when=should_retry,
     max_age=settings.MESSAGE_MAX_AGE_MS,
     throws=(PdfiumError, IDNotFoundError),
 )
 def render_pdf_document(document_id: str):
     with Session(engine) as session:
-        document = session.get(Document, document_id)
+        # Lock the row for the whole render, so a duplicate delivery of the same
+        # message does not render the document a second time in parallel.
+        statement = (
+            select(Document)
+            .where(Document.id == document_id)
+            .with_for_update(skip_locked=True)
+        )
+        document = session.exec(statement).first()
+        if not document and session.get(Document, document_id):
+            raise DocumentLockedError(
+                f"Document {document_id} is being rendered by another worker.",
+                delay=LOCKED_RETRY_DELAY_MS,
+            )
+
+        if document and document.status is DocumentStatus.DONE:
+            logger.info(f"Document {document_id} is already rendered, skipping.")
+            return
+
         if not document or document.status is not DocumentStatus.PROCESSING:
             error = IDNotFoundError(
                 f"DocumentInput for id {document_id} with status {DocumentStatus.PROCESSING} "
@@ -74,13 +120,53 @@ def update_with_error(session: Session, document: Document, error: Exception):
     raise error
 
 
+def is_page_rendered(page_path: Path) -> bool:
+    """
+    Cheaply checks that a rendered page exists and is a complete PNG file,
+    by looking only at its signature and trailing IEND chunk.
+    """
+    try:
+        with open(page_path, "rb") as file:
+            if file.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return False
+            file.seek(-len(PNG_TRAILER), os.SEEK_END)
+            return file.read() == PNG_TRAILER
+    except OSError:
+        return False
+
+
 def render_and_save_pages(document_id: UUID4) -> int:
+    """
+    Renders every page of the uploaded document to a PNG file and returns the number
+    of pages.
+
+    Each page is written to a temporary file and renamed into place only once fully
+    saved, so an existing page file marks that page as done. Pages that are already
+    rendered are skipped, which lets a retried or redelivered task resume where the
+    previous attempt stopped.
+    """
+    # Temporary files of a live writer are recent, so only lost ones are removed
+    for temp_page_path in settings.PAGES_PATH.glob(f"{document_id}_*.png.*.tmp"):
+        try:
+            if time.time() - temp_page_path.stat().st_mtime > STALE_TEMP_PAGE_AGE_S:
+                temp_page_path.unlink(missing_ok=True)
+        except FileNotFoundError:
+            pass
+
     document_path = Path(settings.UPLOADS_PATH / f"{str(document_id)}.pdf")
     pdf_document = pdfium.PdfDocument(document_path)
 
     num_pages = len(pdf_document)
 
     for page_number in range(1, num_pages + 1):
+        page_path = settings.PAGES_PATH / f"{document_id}_{page_number}.png"
+        if is_page_rendered(page_path):
+            logger.info(
+                f"Page {page_number} of document at {document_path} is already "
+                f"rendered, skipping."
+            )
+            continue
+
         logger.info(f"Processing page {page_number} of document at {document_path}.")
         page = pdf_document[page_number - 1]
         pil_image = page.render(
@@ -104,5 +190,13 @@ def render_and_save_pages(document_id: UUID4) -> int:
             pil_image = pil_image.resize(
                 (new_width, new_height), Image.Resampling.LANCZOS
             )
-        pil_image.save(settings.PAGES_PATH / f"{document_id}_{page_number}.png")
+        # Unique per attempt, so two writers of the same page never share a file
+        temp_page_path = page_path.with_name(
+            f"{page_path.name}.{uuid.uuid4().hex}.tmp"
+        )
+        try:
+            pil_image.save(temp_page_path, format="PNG")
+            os.replace(temp_page_path, page_path)
+        finally:
+            temp_page_path.unlink(missing_ok=True)
     return num_pages